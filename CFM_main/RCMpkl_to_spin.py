@@ -28,7 +28,23 @@ import time
 import calendar
 import hl_analytic as hla
 import cmath
+import functools
+import math
 import sys
+try:
+    from numba import njit, prange
+    _HAVE_NUMBA = True
+except ImportError: # numba is optional; without it the solvers below run as plain python
+    _HAVE_NUMBA = False
+    prange = range
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+try:
+    from joblib import Parallel, delayed, effective_n_jobs
+except ImportError: # joblib is optional; it is only used when n_jobs != 1
+    Parallel = None
 
 def toYearFraction(date):
     '''
@@ -48,6 +64,32 @@ def toYearFraction(date):
 
     return date.year + fraction
 
+def decdate_vec(idx):
+    '''
+    convert a DatetimeIndex to decimal dates (vectorized toYearFraction)
+    '''
+    years = idx.year.values.astype(np.int64)
+    year_starts = pd.to_datetime({'year':years,'month':1,'day':1})
+    next_starts = pd.to_datetime({'year':years+1,'month':1,'day':1})
+
+    yearElapsed = (idx.values - year_starts.values).astype('i8')
+    yearDuration = (next_starts.values - year_starts.values).astype('i8')
+    return years + yearElapsed/yearDuration
+
+def mean_timestep(idx):
+    '''
+    mean time step [s] of a DatetimeIndex. The mean of the differences
+    telescopes to (last - first)/(n - 1), so no diff series is needed and
+    this also holds for an irregular index.
+    '''
+    return (idx[-1] - idx[0]).total_seconds()/(len(idx) - 1)
+
+def steps_per_year(decdate):
+    '''
+    mean number of time steps per year of an array of decimal dates
+    '''
+    return (len(decdate) - 1)/(decdate[-1] - decdate[0])
+
 def decyeartodatetime(din):
     start = din
     year = int(start)
@@ -68,6 +110,78 @@ def effectiveT(T):
     km  = np.mean(k)
     return Q/(R*np.log(km))
 
+@njit(cache=True,error_model='numpy')
+def solve_depressed_quartic_vec(a,e):
+    '''
+    Positive real root of a*T^4 + T + e = 0, which is the form the surface
+    energy balance takes (a > 0, e < 0). Works on scalars or arrays.
+
+    Dividing by a gives the depressed quartic T^4 + q*T + r = 0. Its Ferrari
+    resolvent cubic y^3 - r*y - q^2/8 = 0 has a single real root (because
+    r < 0), which is found with the hyperbolic form of Cardano's formula;
+    the positive root of the quartic then follows from one quadratic.
+    '''
+    q = 1.0/a
+    r = e/a
+
+    # real root of the resolvent cubic y^3 + P*y + Q = 0, P > 0
+    P = -r
+    Q = -0.125*q*q
+    sP = np.sqrt(P/3.0)
+    y = -2*sP*np.sinh(np.arcsinh(1.5*Q/(P*sP))/3.0)
+
+    # positive root of T^2 + m*T + y - q/(2m) = 0, m = sqrt(2y), written without cancellation
+    m = np.sqrt(2*y)
+    s = np.sqrt(2*q/m - 2*y)
+    return (q/m - 2*y)/(s + m)
+
+def effectiveT_binned(T,bin_starts):
+    '''
+    The Arrhenius mean temperature of each bin of T, where bin_starts are
+    the indices of the first element of each (contiguous) bin, so T must be
+    in time order. For sorted T this is the same as resampling with
+    effectiveT: NaNs are skipped and empty bins give NaN.
+    '''
+    Q   = -1 * 59500.0
+    R   = 8.314
+    k   = np.exp(Q/(R*T))
+    valid = ~np.isnan(k)
+    starts = np.minimum(bin_starts,len(T)-1)
+    sums = np.add.reduceat(np.where(valid,k,0),starts)
+    counts = np.add.reduceat(valid.astype(np.int64),starts)
+    counts[np.diff(np.r_[bin_starts,len(T)])==0] = 0
+    with np.errstate(divide='ignore',invalid='ignore'):
+        Teff = Q/(R*np.log(sums/counts))
+    Teff[counts==0] = np.nan
+    return Teff
+
+@njit(cache=True,error_model='numpy')
+def _calcSEB_kernel(flux,TS,dt,SBC,CP_I,m,LF_I):
+    '''
+    time-stepping loop of calcSEB. T_0 is the previous step's calculated
+    temperature, so the loop is sequential; numba compiles it when available.
+    '''
+    N = len(flux)
+    Tcalc = np.empty(N)
+    melt = np.empty(N)
+    a = SBC*dt/(CP_I*m)
+    for kk in range(N):
+        if kk==0:
+            T_0 = TS[kk]
+        else:
+            T_0 = Tcalc[kk-1]
+
+        e = -1 * (flux[kk]*dt/(CP_I*m)+T_0)
+        Tnew = solve_depressed_quartic_vec(a,e)
+
+        if Tnew>=273.15:
+            Tcalc[kk] = 273.15
+            melt[kk] = (flux[kk] - SBC*273.15**4) / LF_I * dt #multiply by dt to put in units per time step
+        else:
+            Tcalc[kk] = Tnew
+            melt[kk] = 0.0
+    return Tcalc,melt
+
 def calcSEB(SWGNT,LWGAB,HFLUX,EFLUX,TS,tindex,dt,GHTSKIN=0,dz=0.05,rhos=400):
     '''
     general solver to calculate skin temperature and melt flux based on energy inputs.
@@ -89,52 +203,121 @@ def calcSEB(SWGNT,LWGAB,HFLUX,EFLUX,TS,tindex,dt,GHTSKIN=0,dz=0.05,rhos=400):
     CP_I = 2097.0 
     m = rhos*dz
     LF_I = 333500.0 #[J kg^-1]
-    flux_df1 = (SWGNT + LWGAB + HFLUX + EFLUX + GHTSKIN)
+    flux_df1 = np.asarray(SWGNT + LWGAB + HFLUX + EFLUX + GHTSKIN,dtype=np.float64)
+    dts = np.asarray(TS,dtype=np.float64)
 
-    TcalcH = np.zeros_like(flux_df1)
-    meltmassH = np.zeros_like(flux_df1)
-
-    dts = TS
+    TcalcH,meltmassH = _calcSEB_kernel(flux_df1,dts,float(dt),SBC,CP_I,m,LF_I) # one step per entry of flux; tindex is not used
+    return TcalcH,meltmassH
 
-    # tindex
-    fqs = FQS()
-    for kk,mdate in enumerate(tindex): #loop through all time steps, calculate melt for all lat/lon pairs at that time
-        pmat = np.zeros((5)) # p matrix to put into FQS solver
-        if kk==0:
-            T_0 = dts[kk]
+def _resample_chunk(sub_df,timeres,res_dict,Tinterp):
+    '''
+    resample the columns in sub_df; if TSKIN is among them it is resampled
+    according to Tinterp (None leaves it as given by res_dict)
+    returns the resampled frame and the resampled TSKIN frame (or None)
+    '''
+    df_re = sub_df.resample(timeres).agg({key:res_dict[key] for key in sub_df.columns})
+    if (Tinterp is None) or ('TSKIN' not in sub_df):
+        return df_re, None
+
+    if Tinterp == 'mean': # the agg above already took the TSKIN mean
+        return df_re, df_re[['TSKIN']]
+
+    df_TS = pd.DataFrame(sub_df.TSKIN)
+    if Tinterp == 'effective':
+        TSKIN = df_TS.TSKIN if df_TS.index.is_monotonic_increasing else df_TS.TSKIN.sort_index() # the bins must be contiguous runs of rows
+        bin_sizes = TSKIN.resample(timeres).size()
+        bin_starts = np.r_[0,np.cumsum(bin_sizes.values)[:-1]]
+        df_TS_re = pd.DataFrame(data=effectiveT_binned(TSKIN.values,bin_starts),index=bin_sizes.index,columns=['TSKIN'])
+    elif Tinterp == 'weighted':
+        df_TS_re = pd.DataFrame(data=(sub_df.BDOT*sub_df.TSKIN).resample(timeres).sum()/(sub_df.BDOT.resample(timeres).sum()),columns=['TSKIN'])
+    df_re.TSKIN = df_TS_re.TSKIN
+    return df_re, df_TS_re
+
+def _resample_CLIM(df_CLIM,timeres,res_dict,Tinterp,n_jobs=1):
+    '''
+    resample df_CLIM, optionally splitting its columns into chunks that are
+    resampled in parallel (joblib). TSKIN and BDOT stay in the same chunk
+    for the accumulation-weighted temperature.
+    '''
+    if n_jobs == 0:
+        raise ValueError('n_jobs must be a positive number of workers or negative (-1 for all cores, -2 for all but one, ...), got 0')
+    if Parallel is not None:
+        n_jobs = effective_n_jobs(n_jobs)
+    if (n_jobs == 1) or (Parallel is None):
+        return _resample_chunk(df_CLIM,timeres,res_dict,Tinterp)
+
+    groups = [[col] for col in df_CLIM.columns if not (Tinterp == 'weighted' and col == 'BDOT')]
+    if Tinterp == 'weighted':
+        groups = [col + ['BDOT'] if col == ['TSKIN'] else col for col in groups]
+    n_jobs = min(n_jobs,len(groups))
+    chunks = [sum(groups[ii::n_jobs],[]) for ii in range(n_jobs)]
+
+    results = Parallel(n_jobs=n_jobs,backend='loky')(delayed(_resample_chunk)(df_CLIM[cols],timeres,res_dict,Tinterp) for cols in chunks)
+    df_CLIM_re = pd.concat([rr[0] for rr in results],axis=1)[list(df_CLIM.columns)]
+    df_TS_re = next((rr[1] for rr in results if rr[1] is not None), None)
+    return df_CLIM_re, df_TS_re
+
+def _assemble_CD(df_CLIM_re,df_CLIM_ids,sub,msk,stepsperyear,mass_ids):
+    '''
+    build the forcing dictionary: the reference climate interval (the rows
+    in msk) repeated once for each offset in sub, followed by the full record.
+    Columns in mass_ids are converted to m ice eq. per year.
+    The spin up part of each column is written by broadcasting the interval
+    into a (len(sub), nu) view of the output, so each column is copied once.
+    '''
+    vals = {ID:df_CLIM_re[ID].values for ID in df_CLIM_ids}
+    decdate = df_CLIM_re['decdate'].values
+    nsub = len(sub)
+    nu = np.count_nonzero(msk)
+    nspin = nsub*nu
+    rci = slice(0,nu) if msk[:nu].all() else msk # for a sorted record msk is a prefix, and a slice is a view rather than a copy
+
+    conv = stepsperyear / 917
+
+    CD = {}
+    CD['time'] = np.empty(nspin+len(decdate))
+    CD['time'][:nspin].reshape(nsub,nu)[...] = sub[:,np.newaxis]+decdate[rci]
+    CD['time'][nspin:] = decdate
+    for ID in df_CLIM_ids:
+        core = vals[ID]
+        full_col = np.empty(nspin+len(core),dtype=core.dtype)
+        full_col[:nspin].reshape(nsub,nu)[...] = core[rci]
+        full_col[nspin:] = core
+        if ID in mass_ids:
+            CD[ID] = full_col * conv
         else:
-            T_0 = TcalcH[kk-1]
+            CD[ID] = full_col
+    return CD
 
-        a = SBC*dt/(CP_I*m)
-        b = 0
-        c = 0
-        d = 1
-        e = -1 * (flux_df1[kk]*dt/(CP_I*m)+T_0)
+RES_DICT_ALL = {'SMELT':'sum','BDOT':'sum','RAIN':'sum','TSKIN':'mean','SUBLIM':'sum','SRHO':'mean'} # resample type for all possible variables
 
-        pmat[0] = a
-        pmat[3] = d
-        pmat[4] = e
-        pmat[np.isnan(pmat)] = 0
+# RES_DICT_ALL_SEB = ({'SMELT':'sum','BDOT':'sum','RAIN':'sum','TSKIN':'mean','T2m':'mean',
+#                'ALBEDO':'mean','QL':'mean','QH':'mean','SUBLIM':'sum','SW_d':'mean'}) # resample type for all possible variables
 
-        r = fqs.quartic_roots(pmat)
-        Tnew = (r[((np.isreal(r)) & (r>0))].real)
-        Tnew[np.isnan(e)] = np.nan
+# RES_DICT_ALL_SEB = ({'BDOT':'sum','RAIN':'sum','TSKIN':'mean','T2m':'mean',
+#                'ALBEDO':'mean','QL':'sum','QH':'sum','SUBLIM':'sum','SW_d':'sum','LW_d':'sum'}) # resample type for all possible variables
 
-        if Tnew>=273.15:
-            TcalcH[kk] = 273.15000000000000        
-            meltmassH[kk] = (flux_df1[kk] - SBC*273.15**4) / LF_I * dt #multiply by dt to put in units per time step
-
-        else:
-            try:
-                TcalcH[kk] = Tnew
-            except:
-                print(kk)
-                print(Tnew)
-            meltmassH[kk] = 0
-            
-    return TcalcH,meltmassH
+RES_DICT_ALL_SEB = ({'BDOT':'sum','RAIN':'sum','TSKIN':'mean','T2m':'mean',
+               'ALBEDO':'mean','QL':'mean','QH':'mean','SUBLIM':'sum','SW_d':'mean','LW_d':'mean','LW_u':'mean'}) # resample type for all possible variables (SEB module runs)
 
-def makeSpinFiles(CLIM_name,timeres='1D',Tinterp='mean',spin_date_st = 1980.0, spin_date_end = 1995.0,melt=False,desired_depth = None,SEB=False,rho_bottom=916,calc_melt=False,num_reps=None):
+@functools.lru_cache(maxsize=32)
+def _setup_schema(cols_tuple,SEB=False):
+    '''
+    columns to drop from df_CLIM and the resample type of the ones that are
+    kept, for a given set of columns. Cached, because sweeps and ensembles
+    call makeSpinFiles many times with the same climate-file columns.
+    returns (notin, res_items), both tuples; dict(res_items) is the res_dict
+    '''
+    if SEB:
+        res_dict_all = RES_DICT_ALL_SEB
+        notin = tuple(col for col in cols_tuple if col == 'SMELT')
+    else:
+        res_dict_all = RES_DICT_ALL
+        notin = tuple(col for col in cols_tuple if col not in res_dict_all)
+    res_items = tuple((key,res_dict_all[key]) for key in cols_tuple if key not in notin)
+    return notin, res_items
+
+def makeSpinFiles(CLIM_name,timeres='1D',Tinterp='mean',spin_date_st = 1980.0, spin_date_end = 1995.0,melt=False,desired_depth = None,SEB=False,rho_bottom=916,calc_melt=False,num_reps=None,n_jobs=1):
     '''
     load a pandas dataframe, called df_CLIM, that will be resampled and then used 
     to create a time series of climate variables for spin up. 
@@ -165,6 +348,12 @@ def makeSpinFiles(CLIM_name,timeres='1D',Tinterp='mean',spin_date_st = 1980.0, s
          decimal date of the start of the reference climate interval (RCI)
      spin_date_end: float
          decimal date of the end of the RCI
+     n_jobs: int
+         number of worker processes for the resampling. Positive values are
+         a worker count; negative values follow joblib (-1 uses all cores,
+         -2 all but one, ...); 0 is an error. Only helps for long,
+         many-column inputs; needs joblib (without it the resampling runs
+         serially).
 
     Returns
     -------
@@ -187,6 +376,7 @@ def makeSpinFiles(CLIM_name,timeres='1D',Tinterp='mean',spin_date_st = 1980.0, s
     '''
 
     SPY = 365.25*24*3600
+    massIDs = ['SMELT','BDOT','RAIN','SUBLIM','EVAP'] # these are converted from kg/m2/timestep to m ice eq./year
 
     if type(CLIM_name) == str:
         df_CLIM = pd.read_pickle(CLIM_name)
@@ -196,64 +386,44 @@ def makeSpinFiles(CLIM_name,timeres='1D',Tinterp='mean',spin_date_st = 1980.0, s
     if (not SEB and not calc_melt): # just use T_surf and melt from the input climate
 
         drn = {'TS':'TSKIN','EVAP':'SUBLIM'} #customize this to change your dataframe column names to match the required inputs
-        try:
+        if ('PRECTOT' in df_CLIM.columns) and ('PRECSNO' in df_CLIM.columns):
             df_CLIM['RAIN'] = df_CLIM['PRECTOT'] - df_CLIM['PRECSNO']
             df_CLIM['BDOT'] = df_CLIM['PRECSNO'] #+ df_CLIM['EVAP']
             # df_CLIM['SUBLIM'] = df_CLIM[]
 
-        except:
-            pass
         df_CLIM.rename(mapper=drn,axis=1,inplace=True)
-        try:
-            df_CLIM.drop(['EVAP','PRECTOT','PRECSNO'],axis=1,inplace=True)
-        except:
-            pass
-        l1 = df_CLIM.columns.values.tolist()
-        l2 = ['SMELT','BDOT','RAIN','TSKIN','SUBLIM','SRHO']
-        notin = list(np.setdiff1d(l1,l2))
-        df_CLIM.drop(notin,axis=1,inplace=True)
-        # df_BDOT = pd.DataFrame(df_CLIM.BDOT)
-        df_TS = pd.DataFrame(df_CLIM.TSKIN)
-
-        res_dict_all = {'SMELT':'sum','BDOT':'sum','RAIN':'sum','TSKIN':'mean','SUBLIM':'sum','SRHO':'mean'} # resample type for all possible variables
-        res_dict = {key:res_dict_all[key] for key in df_CLIM.columns} # resample type for just the data types in df_CLIM
-
-        # df_BDOT_re = df_BDOT.resample(timeres).sum()
-        if Tinterp == 'mean':
-            df_TS_re = df_TS.resample(timeres).mean()
-        elif Tinterp == 'effective':
-            df_TS_re = df_TS.resample(timeres).apply(effectiveT)
-        elif Tinterp == 'weighted':
-            df_TS_re = pd.DataFrame(data=(df_BDOT.BDOT*df_TS.TSKIN).resample(timeres).sum()/(df_BDOT.BDOT.resample(timeres).sum()),columns=['TSKIN'])
-            # pass
-
-        df_CLIM_re = df_CLIM.resample(timeres).agg(res_dict)
-        df_CLIM_re.TSKIN = df_TS_re.TSKIN
+        cols_to_drop = [col for col in ['EVAP','PRECTOT','PRECSNO'] if col in df_CLIM.columns]
+        df_CLIM.drop(cols_to_drop,axis=1,inplace=True)
+        notin, res_items = _setup_schema(tuple(df_CLIM.columns))
+        df_CLIM.drop(list(notin),axis=1,inplace=True)
+
+        res_dict = dict(res_items) # resample type for just the data types in df_CLIM
+
+        df_CLIM_re, df_TS_re = _resample_CLIM(df_CLIM,timeres,res_dict,Tinterp,n_jobs)
         df_CLIM_ids = list(df_CLIM_re.columns)
 
-        df_CLIM_re['decdate'] = [toYearFraction(qq) for qq in df_CLIM_re.index]
+        df_CLIM_re['decdate'] = decdate_vec(df_CLIM_re.index)
         df_CLIM_re = df_CLIM_re.ffill()
 
         # df_TS_re['decdate'] = [toYearFraction(qq) for qq in df_TS_re.index]
         # df_BDOT_re['decdate'] = [toYearFraction(qq) for qq in df_BDOT_re.index]
         # df_TS_re = df_TS_re.fillna(method='pad')
 
-        stepsperyear = 1/(df_CLIM_re.decdate.diff().mean())
+        stepsperyear = steps_per_year(df_CLIM_re.decdate.values)
 
         if 'SUBLIM' not in df_CLIM_re:
             df_CLIM_re['SUBLIM'] = np.zeros_like(df_CLIM_re['BDOT'])
             print('SUBLIM not in df_CLIM! (RCMpkl_to_spin.py, 232')
 
-        BDOT_mean_IE = ((df_CLIM_re['BDOT']+df_CLIM_re['SUBLIM'])*stepsperyear/917).mean()
+        BDOT_mean_IE = np.nanmean(df_CLIM_re['BDOT'].values+df_CLIM_re['SUBLIM'].values) * stepsperyear / 917
         T_mean = (df_TS_re['TSKIN']).mean()
 
         hh  = np.arange(0,501)
         age, rho = hla.hl_analytic(350,hh,T_mean,BDOT_mean_IE)    
         if not desired_depth:
             # desired_depth = hh[np.where(rho>=916)[0][0]]
-            desired_depth = hh[np.where(rho>=rho_bottom)[0][0]]
-            depth_S1 = hh[np.where(rho>=450)[0][0]]
-            depth_S2 = hh[np.where(rho>=650)[0][0]]
+            idx = np.searchsorted(rho,[rho_bottom,450.0,650.0]) # rho increases with depth, so this is the first depth at or above each density
+            desired_depth, depth_S1, depth_S2 = hh[idx[0]], hh[idx[1]], hh[idx[2]]
         else:
             desired_depth = desired_depth
             depth_S1 = desired_depth * 0.5
@@ -273,36 +443,7 @@ def makeSpinFiles(CLIM_name,timeres='1D',Tinterp='mean',spin_date_st = 1980.0, s
         startstring = '{}/{}/{}'.format(startday,startmonth,startyear)
 
         msk = df_CLIM_re.decdate.values<spin_date_end+1
-        spin_days = df_CLIM_re.decdate.values[msk]
-
-        smb_spin = df_CLIM_re['BDOT'][msk].values
-        tskin_spin = df_CLIM_re['TSKIN'][msk].values
-
-        nu = len(spin_days)
-        spin_days_all = np.zeros(len(sub)*nu)
-        smb_spin_all = np.zeros_like(spin_days_all)
-        tskin_spin_all = np.zeros_like(spin_days_all)
-
-        spin_days_all = (sub[:,np.newaxis]+spin_days).flatten()
-        spin_dict = {}
-        for ID in df_CLIM_ids:
-            spin_dict[ID] = np.tile(df_CLIM_re[ID][msk].values, len(sub))
-
-        df_CLIM_decdate = df_CLIM_re.set_index('decdate')
-        df_spin = pd.DataFrame(spin_dict,index = spin_days_all)
-        df_spin.index.name = 'decdate'
-
-        df_FULL = pd.concat([df_spin,df_CLIM_decdate])
-
-        CD = {}
-        CD['time'] = df_FULL.index
-        for ID in df_CLIM_ids:
-            if ID == 'TSKIN':
-                CD[ID] = df_FULL[ID].values
-            elif ID=='SRHO':
-                CD[ID] = df_FULL[ID].values
-            else:
-                CD[ID] = df_FULL[ID].values * stepsperyear / 917
+        CD = _assemble_CD(df_CLIM_re,df_CLIM_ids,sub,msk,stepsperyear,massIDs)
 
         SEBfluxes = None
 
@@ -313,18 +454,14 @@ def makeSpinFiles(CLIM_name,timeres='1D',Tinterp='mean',spin_date_st = 1980.0, s
         #(this is something of a pre-calculation of the melt.)
 
         drn = {'TS':'TSKIN','EVAP':'SUBLIM'} #customize this to change your dataframe column names to match the required inputs
-        try:
+        if ('PRECTOT' in df_CLIM.columns) and ('PRECSNO' in df_CLIM.columns):
             df_CLIM['RAIN'] = df_CLIM['PRECTOT'] - df_CLIM['PRECSNO']
             df_CLIM['BDOT'] = df_CLIM['PRECSNO'] #+ df_CLIM['EVAP']
             # df_CLIM['SUBLIM'] = df_CLIM[]
 
-        except:
-            pass
         df_CLIM.rename(mapper=drn,axis=1,inplace=True)
-        try:
-            df_CLIM.drop(['EVAP','PRECTOT','PRECSNO'],axis=1,inplace=True)
-        except:
-            pass
+        cols_to_drop = [col for col in ['EVAP','PRECTOT','PRECSNO'] if col in df_CLIM.columns]
+        df_CLIM.drop(cols_to_drop,axis=1,inplace=True)
         #############
 
         df_CLIM['ALBEDO'] = df_CLIM['ALBEDO'].bfill()
@@ -333,52 +470,28 @@ def makeSpinFiles(CLIM_name,timeres='1D',Tinterp='mean',spin_date_st = 1980.0, s
         SBC = 5.67e-8
         CP_I = 2097.0 
         m = 400*0.08
-        dt = df_CLIM.index.to_series().diff().dt.total_seconds().mean()
+        dt = mean_timestep(df_CLIM.index)
         LF_I = 333500.0 #[J kg^-1]
         flux_df1 = ((df_CLIM['SW_d'] * (1 - df_CLIM['ALBEDO'])) + df_CLIM['LW_d'] + df_CLIM['QH'] + df_CLIM['QL']) #make sure that merra2 QH and QL are multiplied by -1 to make them 'into' the layer
         flux_df1_r = flux_df1.values#.reshape(flux_df1.shape[0],-1)
         # oshape = np.shape(flux_df1.values)
         
-        Tcalc = np.zeros_like(flux_df1_r)
-        meltmass = np.zeros_like(flux_df1_r)
-
         dts = df_CLIM.TSKIN.values
         # dts_r = dts.reshape(dts.shape[0],-1)
         # dsha = dts_r.shape[-1]
 
-        # tindex = df_CLIM.time.data
-        tindex = df_CLIM.index
-        for kk,mdate in enumerate(tindex): #loop through all time steps, calculate melt for all lat/lon pairs at that time
-            pmat = np.zeros(5) # p matrix to put into FQS solver
-
-            if kk==0:
-                T_0 = dts[kk]
-            else:
-                T_0 = dts[kk-1]
-
-            a = SBC * dt / (CP_I*m)
-            b = 0
-            c = 0
-            d = 1
-            e = -1 * (flux_df1_r[kk]*dt/(CP_I*m)+T_0)
-
-            pmat[0] = a
-            pmat[3] = d
-            pmat[4] = e
-            pmat[np.isnan(pmat)] = 0
+        # T_0 is the previous step's input skin temperature (not the calculated one), so every time step is independent
+        T_prev = np.empty_like(dts)
+        T_prev[0] = dts[0]
+        T_prev[1:] = dts[:-1]
 
-            fqs = FQS()
-            r = fqs.quartic_roots(pmat)
-            Tnew = (r[((np.isreal(r)) & (r>0))].real)
-            Tnew[np.isnan(e)] = np.nan
+        a = SBC * dt / (CP_I*m)
+        e_vec = -1 * (flux_df1_r*dt/(CP_I*m)+T_prev)
 
-            if Tnew>=273.15:
-                Tcalc[kk] = 273.15000000000000        
-                meltmass[kk] = (flux_df1[kk] - SBC*273.15**4) / LF_I * dt #multiply by dt to put in units per time step
-
-            else:
-                Tcalc[kk] = Tnew
-                meltmass[kk] = 0
+        T_raw = solve_depressed_quartic_vec(a,e_vec) # NaN where e_vec is NaN
+        melt_msk = T_raw>=273.15
+        Tcalc = np.minimum(T_raw,273.15)
+        meltmass = np.where(melt_msk, (flux_df1_r - SBC*273.15**4) / LF_I * dt, 0.0) #multiply by dt to put in units per time step
 
         Tcalc_out = Tcalc
         meltmass_out = meltmass
@@ -393,30 +506,15 @@ def makeSpinFiles(CLIM_name,timeres='1D',Tinterp='mean',spin_date_st = 1980.0, s
         df_CLIM['TSKIN'] = Tcalc_out
 
         #############
-        l1 = df_CLIM.columns.values.tolist()
-        l2 = ['SMELT','BDOT','RAIN','TSKIN','SUBLIM','SRHO']
-        notin = list(np.setdiff1d(l1,l2))
-        df_CLIM.drop(notin,axis=1,inplace=True)
-        # df_BDOT = pd.DataFrame(df_CLIM.BDOT)
-        df_TS = pd.DataFrame(df_CLIM.TSKIN)
-
-        res_dict_all = {'SMELT':'sum','BDOT':'sum','RAIN':'sum','TSKIN':'mean','SUBLIM':'sum','SRHO':'mean'} # resample type for all possible variables
-        res_dict = {key:res_dict_all[key] for key in df_CLIM.columns} # resample type for just the data types in df_CLIM
-
-        # df_BDOT_re = df_BDOT.resample(timeres).sum()
-        if Tinterp == 'mean':
-            df_TS_re = df_TS.resample(timeres).mean()
-        elif Tinterp == 'effective':
-            df_TS_re = df_TS.resample(timeres).apply(effectiveT)
-        elif Tinterp == 'weighted':
-            df_TS_re = pd.DataFrame(data=(df_BDOT.BDOT*df_TS.TSKIN).resample(timeres).sum()/(df_BDOT.BDOT.resample(timeres).sum()),columns=['TSKIN'])
-            # pass
-
-        df_CLIM_re = df_CLIM.resample(timeres).agg(res_dict)
-        df_CLIM_re.TSKIN = df_TS_re.TSKIN
+        notin, res_items = _setup_schema(tuple(df_CLIM.columns))
+        df_CLIM.drop(list(notin),axis=1,inplace=True)
+
+        res_dict = dict(res_items) # resample type for just the data types in df_CLIM
+
+        df_CLIM_re, df_TS_re = _resample_CLIM(df_CLIM,timeres,res_dict,Tinterp,n_jobs)
         df_CLIM_ids = list(df_CLIM_re.columns)
 
-        df_CLIM_re['decdate'] = [toYearFraction(qq) for qq in df_CLIM_re.index]
+        df_CLIM_re['decdate'] = decdate_vec(df_CLIM_re.index)
         # df_CLIM_re = df_CLIM_re.fillna(method='pad')
         df_CLIM_re = df_CLIM_re.ffill()
 
@@ -424,22 +522,21 @@ def makeSpinFiles(CLIM_name,timeres='1D',Tinterp='mean',spin_date_st = 1980.0, s
         # df_BDOT_re['decdate'] = [toYearFraction(qq) for qq in df_BDOT_re.index]
         # df_TS_re = df_TS_re.fillna(method='pad')
 
-        stepsperyear = 1/(df_CLIM_re.decdate.diff().mean())
+        stepsperyear = steps_per_year(df_CLIM_re.decdate.values)
 
 
         if 'SUBLIM' not in df_CLIM_re:
             df_CLIM_re['SUBLIM'] = np.zeros_like(df_CLIM_re['BDOT'])
 
-        BDOT_mean_IE = ((df_CLIM_re['BDOT']+df_CLIM_re['SUBLIM'])*stepsperyear/917).mean()
+        BDOT_mean_IE = np.nanmean(df_CLIM_re['BDOT'].values+df_CLIM_re['SUBLIM'].values) * stepsperyear / 917
         T_mean = (df_TS_re['TSKIN']).mean()
 
         hh  = np.arange(0,501)
         age, rho = hla.hl_analytic(350,hh,T_mean,BDOT_mean_IE)    
         if not desired_depth:
             # desired_depth = hh[np.where(rho>=916)[0][0]]
-            desired_depth = hh[np.where(rho>=rho_bottom)[0][0]]
-            depth_S1 = hh[np.where(rho>=450)[0][0]]
-            depth_S2 = hh[np.where(rho>=650)[0][0]]
+            idx = np.searchsorted(rho,[rho_bottom,450.0,650.0]) # rho increases with depth, so this is the first depth at or above each density
+            desired_depth, depth_S1, depth_S2 = hh[idx[0]], hh[idx[1]], hh[idx[2]]
         else:
             desired_depth = desired_depth
             depth_S1 = desired_depth * 0.5
@@ -456,78 +553,36 @@ def makeSpinFiles(CLIM_name,timeres='1D',Tinterp='mean',spin_date_st = 1980.0, s
         startstring = '{}/{}/{}'.format(startday,startmonth,startyear)
 
         msk = df_CLIM_re.decdate.values<spin_date_end+1
-        spin_days = df_CLIM_re.decdate.values[msk]
-
-        smb_spin = df_CLIM_re['BDOT'][msk].values
-        tskin_spin = df_CLIM_re['TSKIN'][msk].values
-
-        nu = len(spin_days)
-        spin_days_all = np.zeros(len(sub)*nu)
-        smb_spin_all = np.zeros_like(spin_days_all)
-        tskin_spin_all = np.zeros_like(spin_days_all)
-
-        spin_days_all = (sub[:,np.newaxis]+spin_days).flatten()
-        spin_dict = {}
-        for ID in df_CLIM_ids:
-            spin_dict[ID] = np.tile(df_CLIM_re[ID][msk].values, len(sub))
-
-        df_CLIM_decdate = df_CLIM_re.set_index('decdate')
-        df_spin = pd.DataFrame(spin_dict,index = spin_days_all)
-        df_spin.index.name = 'decdate'
-
-        df_FULL = pd.concat([df_spin,df_CLIM_decdate])
-        # df_FULL.to_csv('df_full_noSEB.csv')
-
-        CD = {}
-        CD['time'] = df_FULL.index
-        for ID in df_CLIM_ids:
-            if ID == 'TSKIN':
-                CD[ID] = df_FULL[ID].values
-            elif ID=='SRHO':
-                CD[ID] = df_FULL[ID].values
-            else:
-                CD[ID] = df_FULL[ID].values * stepsperyear / 917
+        CD = _assemble_CD(df_CLIM_re,df_CLIM_ids,sub,msk,stepsperyear,massIDs)
 
         SEBfluxes = None
 
     else: #SEB True - SEB module in CFM will run
 
-        l1 = df_CLIM.columns.values.tolist()
-
-        if 'SMELT' in l1:
-            df_CLIM.drop(['SMELT'],axis=1,inplace=True)
+        notin, res_items = _setup_schema(tuple(df_CLIM.columns),SEB=True)
+        df_CLIM.drop(list(notin),axis=1,inplace=True)
 
         # df_TS = pd.DataFrame(df_CLIM.TSKIN)
 
-        # res_dict_all = ({'SMELT':'sum','BDOT':'sum','RAIN':'sum','TSKIN':'mean','T2m':'mean',
-        #                'ALBEDO':'mean','QL':'mean','QH':'mean','SUBLIM':'sum','SW_d':'mean'}) # resample type for all possible variables
-        
-        # res_dict_all = ({'BDOT':'sum','RAIN':'sum','TSKIN':'mean','T2m':'mean',
-        #                'ALBEDO':'mean','QL':'sum','QH':'sum','SUBLIM':'sum','SW_d':'sum','LW_d':'sum'}) # resample type for all possible variables
+        res_dict = dict(res_items) # resample type for just the data types in df_CLIM
 
-        res_dict_all = ({'BDOT':'sum','RAIN':'sum','TSKIN':'mean','T2m':'mean',
-                       'ALBEDO':'mean','QL':'mean','QH':'mean','SUBLIM':'sum','SW_d':'mean','LW_d':'mean','LW_u':'mean'}) # resample type for all possible variables
-
-        res_dict = {key:res_dict_all[key] for key in df_CLIM.columns} # resample type for just the data types in df_CLIM
-
-        df_CLIM_re = df_CLIM.resample(timeres).agg(res_dict) #Energy fluxes remain W/m2, mass fluxes are in /time step
+        df_CLIM_re, _ = _resample_CLIM(df_CLIM,timeres,res_dict,None,n_jobs) #Energy fluxes remain W/m2, mass fluxes are in /time step
         df_CLIM_ids = list(df_CLIM_re.columns)
 
-        df_CLIM_re['decdate'] = [toYearFraction(qq) for qq in df_CLIM_re.index]
+        df_CLIM_re['decdate'] = decdate_vec(df_CLIM_re.index)
         # df_CLIM_re = df_CLIM_re.fillna(method='pad')
         df_CLIM_re = df_CLIM_re.ffill()
 
         df_CLIM_seb = df_CLIM[res_dict.keys()]
-        df_CLIM_seb.drop(['BDOT','RAIN'],axis=1)
         df_CLIM_seb_ids = list(df_CLIM_seb.columns)
-        df_CLIM_seb['decdate'] = [toYearFraction(qq) for qq in df_CLIM_seb.index]
+        df_CLIM_seb['decdate'] = decdate_vec(df_CLIM_seb.index)
 
-        dtRATIO = df_CLIM_re.index.to_series().diff().mean().total_seconds()/df_CLIM_seb.index.to_series().diff().mean().total_seconds()
+        dtRATIO = mean_timestep(df_CLIM_re.index)/mean_timestep(df_CLIM_seb.index)
 
-        stepsperyear = 1/(df_CLIM_re.decdate.diff().mean())
-        stepsperyear_seb = 1/(df_CLIM_seb.decdate.diff().mean())
+        stepsperyear = steps_per_year(df_CLIM_re.decdate.values)
+        stepsperyear_seb = steps_per_year(df_CLIM_seb.decdate.values)
 
-        BDOT_mean_IE = (df_CLIM_re['BDOT']*stepsperyear/917).mean()
+        BDOT_mean_IE = np.nanmean(df_CLIM_re['BDOT'].values) * stepsperyear / 917
         
         try:
             T_mean = (df_CLIM_re['TSKIN']).mean()
@@ -539,9 +594,8 @@ def makeSpinFiles(CLIM_name,timeres='1D',Tinterp='mean',spin_date_st = 1980.0, s
 
         if not desired_depth:
             # desired_depth = hh[np.where(rho>=916)[0][0]]
-            desired_depth = hh[np.where(rho>=rho_bottom)[0][0]]
-            depth_S1 = hh[np.where(rho>=450)[0][0]]
-            depth_S2 = hh[np.where(rho>=650)[0][0]]
+            idx = np.searchsorted(rho,[rho_bottom,450.0,650.0]) # rho increases with depth, so this is the first depth at or above each density
+            desired_depth, depth_S1, depth_S2 = hh[idx[0]], hh[idx[1]], hh[idx[2]]
         else:
             desired_depth = desired_depth
             depth_S1 = desired_depth * 0.5
@@ -558,64 +612,265 @@ def makeSpinFiles(CLIM_name,timeres='1D',Tinterp='mean',spin_date_st = 1980.0, s
         startstring = '{}/{}/{}'.format(startday,startmonth,startyear)
 
         msk = df_CLIM_re.decdate.values<spin_date_end+1
-        spin_days = df_CLIM_re.decdate.values[msk]
-
         msk_seb = df_CLIM_seb.decdate.values<spin_date_end+1
-        spin_days_seb = df_CLIM_seb.decdate.values[msk_seb]
 
-        # smb_spin = df_CLIM_re['BDOT'][msk].values
-        # tskin_spin = df_CLIM_re['TSKIN'][msk].values
+        CD = _assemble_CD(df_CLIM_re,df_CLIM_ids,sub,msk,stepsperyear,massIDs)
+
+        SEBfluxes = _assemble_CD(df_CLIM_seb,df_CLIM_seb_ids,sub,msk_seb,stepsperyear_seb,massIDs)
+        SEBfluxes['dtRATIO'] = int(dtRATIO)
+
+    return CD, stepsperyear, depth_S1, depth_S2, desired_depth, SEBfluxes
 
-        nu = len(spin_days)
-        spin_days_all = np.zeros(len(sub)*nu)
+### FQS below ###########
+'''
+# Fast Quartic Solver: analytically solves quartic equations (needed to calculate melt)
+# Takes methods from fqs package (@author: NKrvavica)
+# full documentation: https://github.com/NKrvavica/fqs/blob/master/fqs.py
+# The single-equation solvers are module-level so that numba can compile them.
+'''
+third = 1./3.
+sqr3 = math.sqrt(3)
+half_sqr3 = 0.5*sqr3
 
-        nu_seb = len(spin_days_seb)
-        spin_days_all_seb = np.zeros(len(sub)*nu_seb)
+@njit(cache=True)
+def cubic_root(x):
+    ''' Compute cubic root of a real number while maintaining its sign
+    '''
+    if x >= 0:
+        return math.pow(x, third)
+    else:
+        return -math.pow(-x, third)
+
+@njit(cache=True)
+def single_quadratic(a0, b0, c0):
+    ''' 
+    Analytical solver for a single quadratic equation
+    '''
+    a, b = b0 / a0, c0 / a0
 
-        spin_days_all = (sub[:,np.newaxis]+spin_days).flatten()
-        spin_dict = {}
-        for ID in df_CLIM_ids:
-            spin_dict[ID] = np.tile(df_CLIM_re[ID][msk].values, len(sub))
+    # Some repating variables
+    a0 = -0.5*a
+    delta = a0*a0 - b
+    sqrt_delta = cmath.sqrt(delta)
 
-        spin_days_all_seb = (sub[:,np.newaxis]+spin_days_seb).flatten()
-        spin_dict_seb = {}
-        for ID in df_CLIM_seb_ids:
-            spin_dict_seb[ID] = np.tile(df_CLIM_seb[ID][msk_seb].values, len(sub))
+    # Roots
+    r1 = a0 - sqrt_delta
+    r2 = a0 + sqrt_delta
 
-        df_CLIM_decdate = df_CLIM_re.set_index('decdate')
-        df_spin = pd.DataFrame(spin_dict,index = spin_days_all)
-        df_spin.index.name = 'decdate'
+    return r1, r2
 
-        df_CLIM_seb_decdate = df_CLIM_seb.set_index('decdate')
-        df_spin_seb = pd.DataFrame(spin_dict_seb,index = spin_days_all_seb)
-        df_spin_seb.index.name = 'decdate'
 
-        df_FULL = pd.concat([df_spin,df_CLIM_decdate])
+@njit(cache=True)
+def single_cubic(a0, b0, c0, d0):
+    ''' 
+    Analytical closed-form solver for a single cubic equation
+    '''
+    a, b, c = b0 / a0, c0 / a0, d0 / a0
+
+    # Some repeating variables
+    a13 = a*third
+    a2 = a13*a13
+
+    # Additional intermediate variables
+    f = third*b - a2
+    g = a13 * (2*a2 - b) + c
+    h = 0.25*g*g + f*f*f
+
+    if f == g == h == 0:
+        r1 = -cubic_root(c)
+        return r1, r1, r1
+
+    elif h <= 0:
+        j = math.sqrt(-f)
+        k = math.acos(-0.5*g / (j*j*j))
+        m = math.cos(third*k)
+        n = sqr3 * math.sin(third*k)
+        r1 = 2*j*m - a13
+        r2 = -j * (m + n) - a13
+        r3 = -j * (m - n) - a13
+        return r1, r2, r3
+
+    else:
+        sqrt_h = math.sqrt(h)
+        S = cubic_root(-0.5*g + sqrt_h)
+        U = cubic_root(-0.5*g - sqrt_h)
+        S_plus_U = S + U
+        S_minus_U = S - U
+        r1 = S_plus_U - a13
+        real = -0.5*S_plus_U - a13
+        imag = S_minus_U*half_sqr3
+        r2 = complex(real, imag)
+        r3 = complex(real, -imag)
+        return r1, r2, r3
+
+
+@njit(cache=True)
+def single_cubic_one(a0, b0, c0, d0):
+    ''' 
+    Analytical closed-form solver for a single cubic equation
+    '''
+    a, b, c = b0 / a0, c0 / a0, d0 / a0
 
-        # df_FULL.to_csv('df_full_SEB.csv')
+    # Some repeating variables
+    a13 = a*third
+    a2 = a13*a13
 
-        df_FULL_seb = pd.concat([df_spin_seb,df_CLIM_seb_decdate])
+    # Additional intermediate variables
+    f = third*b - a2
+    g = a13 * (2*a2 - b) + c
+    h = 0.25*g*g + f*f*f
 
-        CD = {}
-        CD['time'] = df_FULL.index
-        massIDs = ['SMELT','BDOT','RAIN','SUBLIM','EVAP']
-        for ID in df_CLIM_ids:
-            if ID not in massIDs:
-                CD[ID] = df_FULL[ID].values            
-            else:
-                CD[ID] = df_FULL[ID].values * stepsperyear / 917
+    if f == g == h == 0:
+        return -cubic_root(c)
 
-        SEBfluxes = {}
-        SEBfluxes['time'] = df_FULL_seb.index
-        SEBfluxes['dtRATIO'] = int(dtRATIO)
-        for ID in df_CLIM_seb_ids:
-            if ID not in massIDs:
-                SEBfluxes[ID] = df_FULL_seb[ID].values            
-            else:
-                SEBfluxes[ID] = df_FULL_seb[ID].values * stepsperyear_seb / 917
+    elif h <= 0:
+        j = math.sqrt(-f)
+        k = math.acos(-0.5*g / (j*j*j))
+        m = math.cos(third*k)
+        return 2*j*m - a13
 
+    else:
+        sqrt_h = math.sqrt(h)
+        S = cubic_root(-0.5*g + sqrt_h)
+        U = cubic_root(-0.5*g - sqrt_h)
+        S_plus_U = S + U
+        return S_plus_U - a13
 
-    return CD, stepsperyear, depth_S1, depth_S2, desired_depth, SEBfluxes
+
+@njit(cache=True)
+def single_quartic(a0, b0, c0, d0, e0):
+    '''
+    Analytical closed-form solver for a single quartic equation
+    '''
+    a, b, c, d = b0/a0, c0/a0, d0/a0, e0/a0
+
+    # Some repeating variables
+    a0 = 0.25*a
+    a02 = a0*a0
+
+    # Coefficients of subsidiary cubic euqtion
+    p = 3*a02 - 0.5*b
+    q = a*a02 - b*a0 + 0.5*c
+    r = 3*a02*a02 - b*a02 + c*a0 - d
+
+    # One root of the cubic equation
+    z0 = single_cubic_one(1, p, r, p*r - 0.5*q*q)
+
+    # Additional variables
+    s = cmath.sqrt(2*p + 2*z0 + 0j)
+    if s == 0:
+        t = z0*z0 + r
+    else:
+        t = -q / s
+
+    # Compute roots by quadratic equations
+    r0, r1 = single_quadratic(1, s, z0 + t)
+    r2, r3 = single_quadratic(1, -s, z0 - t)
+
+    return r0 - a0, r1 - a0, r2 - a0, r3 - a0
+
+@njit(parallel=True, cache=True)
+def cubic_roots_batch(P):
+    '''
+    Solve many cubic equations at once. P is an (N,4) array of
+    coefficients; returns an (N,3) complex array of roots.
+    '''
+    n = P.shape[0]
+    roots = np.empty((n, 3), dtype=np.complex128)
+    for i in prange(n):
+        r1, r2, r3 = single_cubic(P[i, 0], P[i, 1], P[i, 2], P[i, 3])
+        roots[i, 0] = r1
+        roots[i, 1] = r2
+        roots[i, 2] = r3
+    return roots
+
+@njit(parallel=True, cache=True)
+def quartic_roots_batch(P):
+    '''
+    Solve many quartic equations at once. P is an (N,5) array of
+    coefficients; returns an (N,4) complex array of roots.
+    '''
+    n = P.shape[0]
+    roots = np.empty((n, 4), dtype=np.complex128)
+    for i in prange(n):
+        r0, r1, r2, r3 = single_quartic(P[i, 0], P[i, 1], P[i, 2], P[i, 3], P[i, 4])
+        roots[i, 0] = r0
+        roots[i, 1] = r1
+        roots[i, 2] = r2
+        roots[i, 3] = r3
+    return roots
+
+@njit(parallel=True, cache=True)
+def _multi_cubic_kernel(a0, b0, c0, d0, out_r1, out_r2, out_r3):
+    '''
+    Element-wise single_cubic over 1-d coefficient arrays, writing the three
+    roots into the preallocated complex arrays out_r1, out_r2, out_r3.
+    '''
+    for i in prange(a0.shape[0]):
+        r1, r2, r3 = single_cubic(a0[i], b0[i], c0[i], d0[i])
+        out_r1[i] = r1
+        out_r2[i] = r2
+        out_r3[i] = r3
+
+@njit(parallel=True, cache=True)
+def _multi_cubic_one_kernel(a0, b0, c0, d0, out_r1):
+    '''
+    Element-wise single_cubic_one (the real root only) over 1-d arrays.
+    '''
+    for i in prange(a0.shape[0]):
+        out_r1[i] = single_cubic_one(a0[i], b0[i], c0[i], d0[i])
+
+@njit(parallel=True, cache=True)
+def _multi_quartic_kernel(a0, b0, c0, d0, e0, out_r0, out_r1, out_r2, out_r3):
+    '''
+    Element-wise single_quartic over 1-d coefficient arrays, writing the four
+    roots into the preallocated complex arrays out_r0 ... out_r3.
+    '''
+    for i in prange(a0.shape[0]):
+        r0, r1, r2, r3 = single_quartic(a0[i], b0[i], c0[i], d0[i], e0[i])
+        out_r0[i] = r0
+        out_r1[i] = r1
+        out_r2[i] = r2
+        out_r3[i] = r3
+
+FQS_TILE = 4096 # elements per block in the numpy FQS solvers; keeps their temporaries in cache
+
+def _roots_buffer(k, shape, dtype):
+    '''
+    Empty (k,) + shape array for k roots, laid out with the roots axis last in
+    memory so that the transpose returned by cubic_roots/quartic_roots is
+    already C-contiguous.
+    '''
+    return np.moveaxis(np.empty(tuple(shape) + (k,), dtype=dtype), -1, 0)
+
+def _solve_tiled(solver, coefs, **kwargs):
+    '''
+    Apply a vector FQS solver block by block (FQS_TILE elements at a time)
+    along long 1-d coefficient arrays, writing into one preallocated output.
+    '''
+    coefs = np.broadcast_arrays(*coefs)
+    n = coefs[0].shape[0]
+    out = None
+    for start in range(0, n, FQS_TILE):
+        sl = slice(start, start + FQS_TILE)
+        roots = np.asarray(solver(*(x[sl] for x in coefs), **kwargs))
+        if out is None:
+            if roots.ndim == 1:
+                out = np.empty(n, dtype=roots.dtype)
+            else:
+                out = _roots_buffer(roots.shape[0], (n,), roots.dtype)
+        out[..., sl] = roots
+    return out
+
+def _sqrt_real_or_complex(x):
+    '''
+    Square root that only switches to complex arithmetic if some element of a
+    real x is negative (or NaN); the common all-nonnegative case stays a real
+    sqrt.
+    '''
+    if np.iscomplexobj(x) or np.all(x >= 0):
+        return np.sqrt(x)
+    return np.sqrt(x + 0j)
 
 class FQS:
     '''
@@ -626,149 +881,32 @@ class FQS:
     def __init__(self):
         pass
 
-    # @jit(nopython=True)``
     def single_quadratic(self, a0, b0, c0):
         ''' 
         Analytical solver for a single quadratic equation
         '''
-        a, b = b0 / a0, c0 / a0
-
-        # Some repating variables
-        a0 = -0.5*a
-        delta = a0*a0 - b
-        sqrt_delta = cmath.sqrt(delta)
-
-        # Roots
-        r1 = a0 - sqrt_delta
-        r2 = a0 + sqrt_delta
-
-        return r1, r2
+        return single_quadratic(a0, b0, c0)
 
 
-    # @jit(nopython=True)
     def single_cubic(self, a0, b0, c0, d0):
         ''' 
         Analytical closed-form solver for a single cubic equation
         '''
-        a, b, c = b0 / a0, c0 / a0, d0 / a0
+        return single_cubic(a0, b0, c0, d0)
 
-        # Some repeating constants and variables
-        third = 1./3.
-        a13 = a*third
-        a2 = a13*a13
-        sqr3 = math.sqrt(3)
 
-        # Additional intermediate variables
-        f = third*b - a2
-        g = a13 * (2*a2 - b) + c
-        h = 0.25*g*g + f*f*f
-
-        def cubic_root(x):
-            ''' Compute cubic root of a number while maintaining its sign'''
-            if x.real >= 0:
-                return x**third
-            else:
-                return -(-x)**third
-
-        if f == g == h == 0:
-            r1 = -cubic_root(c)
-            return r1, r1, r1
-
-        elif h <= 0:
-            j = math.sqrt(-f)
-            k = math.acos(-0.5*g / (j*j*j))
-            m = math.cos(third*k)
-            n = sqr3 * math.sin(third*k)
-            r1 = 2*j*m - a13
-            r2 = -j * (m + n) - a13
-            r3 = -j * (m - n) - a13
-            return r1, r2, r3
-
-        else:
-            sqrt_h = cmath.sqrt(h)
-            S = cubic_root(-0.5*g + sqrt_h)
-            U = cubic_root(-0.5*g - sqrt_h)
-            S_plus_U = S + U
-            S_minus_U = S - U
-            r1 = S_plus_U - a13
-            r2 = -0.5*S_plus_U - a13 + S_minus_U*sqr3*0.5j
-            r3 = -0.5*S_plus_U - a13 - S_minus_U*sqr3*0.5j
-            return r1, r2, r3
-
-
-    # @jit(nopython=True)
     def single_cubic_one(self, a0, b0, c0, d0):
         ''' 
-        Analytical closed-form solver for a single cubic equation
+        Analytical closed-form solver for a single cubic equation (one root)
         '''
-        a, b, c = b0 / a0, c0 / a0, d0 / a0
-
-        # Some repeating constants and variables
-        third = 1./3.
-        a13 = a*third
-        a2 = a13*a13
-
-        # Additional intermediate variables
-        f = third*b - a2
-        g = a13 * (2*a2 - b) + c
-        h = 0.25*g*g + f*f*f
-
-        def cubic_root(x):
-            ''' Compute cubic root of a number while maintaining its sign
-            '''
-            if x.real >= 0:
-                return x**third
-            else:
-                return -(-x)**third
-
-        if f == g == h == 0:
-            return -cubic_root(c)
+        return single_cubic_one(a0, b0, c0, d0)
 
-        elif h <= 0:
-            j = math.sqrt(-f)
-            k = math.acos(-0.5*g / (j*j*j))
-            m = math.cos(third*k)
-            return 2*j*m - a13
 
-        else:
-            sqrt_h = cmath.sqrt(h)
-            S = cubic_root(-0.5*g + sqrt_h)
-            U = cubic_root(-0.5*g - sqrt_h)
-            S_plus_U = S + U
-            return S_plus_U - a13
-
-
-    # @jit(nopython=True)
     def single_quartic(self, a0, b0, c0, d0, e0):
         '''
         Analytical closed-form solver for a single quartic equation
         '''
-        a, b, c, d = b0/a0, c0/a0, d0/a0, e0/a0
-
-        # Some repeating variables
-        a0 = 0.25*a
-        a02 = a0*a0
-
-        # Coefficients of subsidiary cubic euqtion
-        p = 3*a02 - 0.5*b
-        q = a*a02 - b*a0 + 0.5*c
-        r = 3*a02*a02 - b*a02 + c*a0 - d
-
-        # One root of the cubic equation
-        z0 = self.single_cubic_one(1, p, r, p*r - 0.5*q*q)
-
-        # Additional variables
-        s = cmath.sqrt(2*p + 2*z0.real + 0j)
-        if s == 0:
-            t = z0*z0 + r
-        else:
-            t = -q / s
-
-        # Compute roots by quadratic equations
-        r0, r1 = self.single_quadratic(1, s, z0 + t)
-        r2, r3 = self.single_quadratic(1, -s, z0 - t)
-
-        return r0 - a0, r1 - a0, r2 - a0, r3 - a0
+        return single_quartic(a0, b0, c0, d0, e0)
 
 
     def multi_quadratic(self, a0, b0, c0):
@@ -792,14 +930,30 @@ class FQS:
     def multi_cubic(self, a0, b0, c0, d0, all_roots=True):
         '''
         Analytical closed-form solver for multiple cubic equations
+        With all_roots=False only the real root is computed and it is returned
+        as a real (not complex) array.
         '''
+        if _HAVE_NUMBA: # one fused pass with scalar temporaries
+            ftype = np.result_type(*(np.asarray(x).dtype for x in (a0, b0, c0, d0)), np.float32) # on dtypes, not values: float32 in, complex64 out
+            a0, b0, c0, d0 = np.broadcast_arrays(*(np.asarray(x, dtype=ftype) for x in (a0, b0, c0, d0)))
+            if all_roots:
+                roots = _roots_buffer(3, (a0.size,), np.result_type(ftype, np.complex64))
+                _multi_cubic_kernel(a0.ravel(), b0.ravel(), c0.ravel(), d0.ravel(), roots[0], roots[1], roots[2])
+                return roots.reshape((3,) + a0.shape)
+            else:
+                r1 = np.empty(a0.shape, dtype=ftype)
+                _multi_cubic_one_kernel(a0.ravel(), b0.ravel(), c0.ravel(), d0.ravel(), r1.ravel())
+                return r1
+
+        shape = np.broadcast(a0, b0, c0, d0).shape
+        if len(shape) == 1 and shape[0] > FQS_TILE:
+            return _solve_tiled(self.multi_cubic, (a0, b0, c0, d0), all_roots=all_roots)
+
         a, b, c = b0 / a0, c0 / a0, d0 / a0
 
-        # Some repeating constants and variables
-        third = 1./3.
+        # Some repeating variables
         a13 = a*third
         a2 = a13*a13
-        sqr3 = math.sqrt(3)
 
         # Additional intermediate variables
         f = third*b - a2
@@ -811,67 +965,46 @@ class FQS:
         m2 = (~m1) & (h <= 0)                   # roots are real and distinct
         m3 = (~m1) & (~m2)                      # one real root and two complex
 
-        def cubic_root(x):
-            ''' Compute cubic root of a number while maintaining its sign
-            '''
-            root = np.zeros_like(x)
-            positive = (x >= 0)
-            negative = ~positive
-            root[positive] = x[positive]**third
-            root[negative] = -(-x[negative])**third
-            return root
-
-        def roots_all_real_equal(c):
-            ''' Compute cubic roots if all roots are real and equal
-            '''
-            r1 = -cubic_root(c)
-            if all_roots:
-                return r1, r1, r1
-            else:
-                return r1
-
-        def roots_all_real_distinct(a13, f, g, h):
-            ''' Compute cubic roots if all roots are real and distinct
-            '''
-            j = np.sqrt(-f)
-            k = np.arccos(-0.5*g / (j*j*j))
-            m = np.cos(third*k)
-            r1 = 2*j*m - a13
-            if all_roots:
-                n = sqr3 * np.sin(third*k)
-                r2 = -j * (m + n) - a13
-                r3 = -j * (m - n) - a13
-                return r1, r2, r3
-            else:
-                return r1
-
-        def roots_one_real(a13, g, h):
-            ''' Compute cubic roots if one root is real and other two are complex
-            '''
-            sqrt_h = np.sqrt(h)
-            S = cubic_root(-0.5*g + sqrt_h)
-            U = cubic_root(-0.5*g - sqrt_h)
-            S_plus_U = S + U
-            r1 = S_plus_U - a13
-            if all_roots:
-                S_minus_U = S - U
-                r2 = -0.5*S_plus_U - a13 + S_minus_U*sqr3*0.5j
-                r3 = -0.5*S_plus_U - a13 - S_minus_U*sqr3*0.5j
-                return r1, r2, r3
-            else:
-                return r1
-
-        # Compute roots
-        if all_roots:
-            roots = np.zeros((3, len(a))).astype(complex)
-            roots[:, m1] = roots_all_real_equal(c[m1])
-            roots[:, m2] = roots_all_real_distinct(a13[m2], f[m2], g[m2], h[m2])
-            roots[:, m3] = roots_one_real(a13[m3], g[m3], h[m3])
-        else:
-            roots = np.zeros(len(a))  # .astype(complex)
-            roots[m1] = roots_all_real_equal(c[m1])
-            roots[m2] = roots_all_real_distinct(a13[m2], f[m2], g[m2], h[m2])
-            roots[m3] = roots_one_real(a13[m3], g[m3], h[m3])
+        # Every branch is evaluated on the full vector and the masks pick the
+        # result; the arguments are guarded so that lanes belonging to the
+        # other branches stay finite.
+
+        # Roots are real and equal
+        r1_equal = -np.cbrt(c)
+
+        # Roots are real and distinct
+        j = np.sqrt(np.where(m2, -f, 0.))
+        k = np.arccos(np.where(m2, -0.5*g, 0.) / np.where(m2, j*j*j, 1.))
+        m = np.cos(third*k)
+        r1_distinct = 2*j*m - a13
+
+        # One real root and two complex
+        g_one = np.where(m3, -0.5*g, 0.)
+        sqrt_h = np.sqrt(np.where(m3, h, 0.))
+        S = np.cbrt(g_one + sqrt_h)
+        U = np.cbrt(g_one - sqrt_h)
+        S_plus_U = S + U
+        r1_one = S_plus_U - a13
+
+        r1 = np.where(m1, r1_equal, np.where(m2, r1_distinct, r1_one))
+        if not all_roots:
+            return r1
+
+        # Shared parts of the second and third roots
+        n = sqr3 * np.sin(third*k)
+        jm = -j*m - a13
+        jn = j*n
+        real_one = -0.5*S_plus_U - a13
+        imag_one = (S - U)*half_sqr3
+
+        # Write the roots straight into the output, real and imaginary parts
+        # separately
+        roots = _roots_buffer(3, r1.shape, np.result_type(r1, np.complex64))
+        roots[0] = r1
+        roots[1].real = np.where(m1, r1_equal, np.where(m2, jm - jn, real_one))
+        roots[2].real = np.where(m1, r1_equal, np.where(m2, jm + jn, real_one))
+        roots[1].imag = np.where(m3, imag_one, 0.)
+        roots[2].imag = np.where(m3, -imag_one, 0.)
 
         return roots
 
@@ -880,6 +1013,17 @@ class FQS:
         ''' 
         Analytical closed-form solver for multiple quartic equations
         '''
+        if _HAVE_NUMBA: # one fused pass with scalar temporaries
+            ftype = np.result_type(*(np.asarray(x).dtype for x in (a0, b0, c0, d0, e0)), np.float32) # on dtypes, not values: float32 in, complex64 out
+            a0, b0, c0, d0, e0 = np.broadcast_arrays(*(np.asarray(x, dtype=ftype) for x in (a0, b0, c0, d0, e0)))
+            roots = _roots_buffer(4, (a0.size,), np.result_type(ftype, np.complex64))
+            _multi_quartic_kernel(a0.ravel(), b0.ravel(), c0.ravel(), d0.ravel(), e0.ravel(), roots[0], roots[1], roots[2], roots[3])
+            return roots.reshape((4,) + a0.shape)
+
+        shape = np.broadcast(a0, b0, c0, d0, e0).shape
+        if len(shape) == 1 and shape[0] > FQS_TILE:
+            return _solve_tiled(self.multi_quartic, (a0, b0, c0, d0, e0))
+
         a, b, c, d = b0/a0, c0/a0, d0/a0, e0/a0
 
         # Some repeating variables
@@ -890,30 +1034,51 @@ class FQS:
         p = 3*a02 - 0.5*b
         q = a*a02 - b*a0 + 0.5*c
         r = 3*a02*a02 - b*a02 + c*a0 - d
+        e = p*r - 0.5*q*q
 
         # One root of the cubic equation
-        z0 = self.multi_cubic(1, p, r, p*r - 0.5*q*q, all_roots=False)
+        z0 = self.multi_cubic(1, p, r, e, all_roots=False)
 
         # Additional variables
-        s = np.sqrt(2*p + 2*z0.real + 0j)
-        t = np.zeros_like(s)
+        s = _sqrt_real_or_complex(2*p + 2*z0)
+        t = np.empty_like(s)
         mask = (s == 0)
-        t[mask] = z0[mask]*z0[mask] + r[mask]
-        t[~mask] = -q[~mask] / s[~mask]
+        np.divide(-q, s, out=t, where=~mask)
+        np.copyto(t, z0*z0 + r, where=mask)
 
         # Compute roots by quadratic equations
-        r0, r1 = self.multi_quadratic(1, s, z0 + t) - a0
-        r2, r3 = self.multi_quadratic(1, -s, z0 - t) - a0
+        return self._two_quadratics(s, z0, t, a0)
+
+
+    def _two_quadratics(self, s, z0, t, a0):
+        '''
+        Roots of x**2 + s*x + (z0 + t) and x**2 - s*x + (z0 - t), shifted by
+        -a0; the two quadratics of multi_quartic solved in one pass.
+        '''
+        half_s = 0.5*s
+        delta = half_s*half_s
+        sqrt_delta1 = _sqrt_real_or_complex(delta - (z0 + t))
+        sqrt_delta2 = _sqrt_real_or_complex(delta - (z0 - t))
+        base1 = -half_s - a0
+        base2 = half_s - a0
+
+        roots = _roots_buffer(4, np.shape(s), np.result_type(s, sqrt_delta1, sqrt_delta2, np.complex64))
+        np.subtract(base1, sqrt_delta1, out=roots[0])
+        np.add(base1, sqrt_delta1, out=roots[1])
+        np.subtract(base2, sqrt_delta2, out=roots[2])
+        np.add(base2, sqrt_delta2, out=roots[3])
 
-        return r0, r1, r2, r3
+        return roots
 
 
-    def cubic_roots(self, p):
+    def cubic_roots(self, p, dtype=None):
         '''
         A caller function for a fast cubic root solver (3rd order polynomial).
+        dtype optionally sets the float type of the computation; with
+        np.float32 the roots come back as complex64.
         '''
         # Convert input to array (if input is a list or tuple)
-        p = np.asarray(p)
+        p = np.asarray(p, dtype=dtype)
 
         # If only one set of coefficients is given, add axis
         if p.ndim < 2:
@@ -924,20 +1089,24 @@ class FQS:
             raise ValueError('Expected 3rd order polynomial with 4 '
                              'coefficients, got {:d}.'.format(p.shape[1]))
 
-        if p.shape[0] < 100:
-            roots = [self.single_cubic(*pi) for pi in p]
-            return np.array(roots)
-        else:
-            roots = self.multi_cubic(*p.T)
-            return np.array(roots).T
+        if _HAVE_NUMBA and p.dtype == np.float64:
+            # compiled solver straight on the rows; skips the per-call setup
+            return cubic_roots_batch(np.ascontiguousarray(p))
 
+        # one contiguous row per coefficient, so the solver reads unit-stride arrays
+        cols = np.ascontiguousarray(p.T)
+        roots = self.multi_cubic(*cols)
+        return np.asarray(roots).T
 
-    def quartic_roots(self, p):
+
+    def quartic_roots(self, p, dtype=None):
         '''
         A caller function for a fast quartic root solver (4th order polynomial).
+        dtype optionally sets the float type of the computation; with
+        np.float32 the roots come back as complex64.
         '''
         # Convert input to an array (if input is a list or tuple)
-        p = np.asarray(p)
+        p = np.asarray(p, dtype=dtype)
 
         # If only one set of coefficients is given, add axis
         if p.ndim < 2:
@@ -948,9 +1117,11 @@ class FQS:
             raise ValueError('Expected 4th order polynomial with 5 '
                              'coefficients, got {:d}.'.format(p.shape[1]))
 
-        if p.shape[0] < 100:
-            roots = [self.single_quartic(*pi) for pi in p]
-            return np.array(roots)
-        else:
-            roots = self.multi_quartic(*p.T)
-            return np.array(roots).T
\ No newline at end of file
+        if _HAVE_NUMBA and p.dtype == np.float64:
+            # compiled solver straight on the rows; skips the per-call setup
+            return quartic_roots_batch(np.ascontiguousarray(p))
+
+        # one contiguous row per coefficient, so the solver reads unit-stride arrays
+        cols = np.ascontiguousarray(p.T)
+        roots = self.multi_quartic(*cols)
+        return np.asarray(roots).T
\ No newline at end of file
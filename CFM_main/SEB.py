@@ -699,12 +699,12 @@ def multi_cubic(a0, b0, c0, d0, all_roots=True):
 
     # Compute roots
     if all_roots:
-        roots = np.zeros((3, len(a))).astype(complex)
+        roots = np.empty((3, len(a)), dtype=complex)  # every element is set by one of m1, m2, m3
         roots[:, m1] = roots_all_real_equal(c[m1])
         roots[:, m2] = roots_all_real_distinct(a13[m2], f[m2], g[m2], h[m2])
         roots[:, m3] = roots_one_real(a13[m3], g[m3], h[m3])
     else:
-        roots = np.zeros(len(a))  # .astype(complex)
+        roots = np.empty(len(a))  # every element is set by one of m1, m2, m3
         roots[m1] = roots_all_real_equal(c[m1])
         roots[m2] = roots_all_real_distinct(a13[m2], f[m2], g[m2], h[m2])
         roots[m3] = roots_one_real(a13[m3], g[m3], h[m3])
@@ -884,12 +884,12 @@ def multi_cubic(a0, b0, c0, d0, all_roots=True):
 
     # Compute roots
     if all_roots:
-        roots = np.zeros((3, len(a))).astype(complex)
+        roots = np.empty((3, len(a)), dtype=complex)  # every element is set by one of m1, m2, m3
         roots[:, m1] = roots_all_real_equal(c[m1])
         roots[:, m2] = roots_all_real_distinct(a13[m2], f[m2], g[m2], h[m2])
         roots[:, m3] = roots_one_real(a13[m3], g[m3], h[m3])
     else:
-        roots = np.zeros(len(a))  # .astype(complex)
+        roots = np.empty(len(a))  # every element is set by one of m1, m2, m3
         roots[m1] = roots_all_real_equal(c[m1])
         roots[m2] = roots_all_real_distinct(a13[m2], f[m2], g[m2], h[m2])
         roots[m3] = roots_one_real(a13[m3], g[m3], h[m3])